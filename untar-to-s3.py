@@ -10,6 +10,8 @@ The script will automatically gzip certain file types, and will add a 'Cache-Con
 Requirements:
     Python 2.7+
     boto3 library (to install: sudo pip install boto3)
+    zlib-ng library (optional, faster gzip compression; to install: sudo pip install zlib-ng)
+    rapidgzip library (optional, parallel decompression of .tar.gz files; to install: sudo pip install rapidgzip)
 
 For usage overview::
     python untar-to-s3.py -h
@@ -24,48 +26,167 @@ from __future__ import print_function
 
 import os
 import sys
+import base64
+import hashlib
 import mimetypes
+import posixpath
 import tarfile
 import logging
-import gzip
 import argparse
 import io
+import mmap
+import threading
+import traceback
 from multiprocessing.pool import ThreadPool
 
+# Prefer zlib-ng's SIMD-accelerated deflate when available; fall back to the standard library.
+try:
+    from zlib_ng import zlib_ng as zlib
+except ImportError:
+    import zlib
+
+# rapidgzip decompresses gzipped tarballs on all CPU cores when available.
+try:
+    import rapidgzip
+    RAPIDGZIP_ERRORS = (ValueError, RuntimeError)
+except ImportError:
+    rapidgzip = None
+    RAPIDGZIP_ERRORS = ()
+
 import boto3
-s3 = boto3.resource('s3')
+from boto3.exceptions import S3UploadFailedError
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+# Files at least this large are uploaded in parallel multipart chunks rather than with a single PUT.
+MULTIPART_THRESHOLD = 8 * 1024 * 1024
+# Number of parts of a single file uploaded at once.
+MULTIPART_CONCURRENCY = 4
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=MULTIPART_THRESHOLD, multipart_chunksize=MULTIPART_THRESHOLD,
+                                 max_concurrency=MULTIPART_CONCURRENCY)
+
+# Size of the read buffer used when loading the tarball from disk.
+TARBALL_READ_BUFFER_SIZE = 4 * 1024 * 1024
+
+# Gzipped tarballs at least this large are decompressed with rapidgzip, if installed. Smaller ones aren't worth
+# starting a decompression thread per core for.
+RAPIDGZIP_MIN_SIZE = 64 * 1024 * 1024
 
 # Files of these types will be gzipped before being uploaded to S3 (unless disabled with --no-compress)
 # This list comes from MaxCDN's Gzip compression settings.
-COMPRESSIBLE_FILE_TYPES = ("text/plain",
-                           "text/html",
-                           "text/javascript",
-                           "text/css",
-                           "text/xml",
-                           "application/javascript",
-                           "application/x-javascript",
-                           "application/xml",
-                           "text/x-component",
-                           "application/json",
-                           "application/xhtml+xml",
-                           "application/rss+xml",
-                           "application/atom+xml",
-                           "app/vdn.ms-fontobject",
-                           "image/svg+xml",
-                           "application/x-font-ttf",
-                           "font/opentype",
-                           "application/octet-stream",
-)
-
-
-def __deploy_asset_to_s3(data, path, size, bucket_name, compress=True):
-    """
-    Deploy a single asset file to an S3 bucket
+COMPRESSIBLE_FILE_TYPES = frozenset(("text/plain",
+                                      "text/html",
+                                      "text/javascript",
+                                      "text/css",
+                                      "text/xml",
+                                      "application/javascript",
+                                      "application/x-javascript",
+                                      "application/xml",
+                                      "text/x-component",
+                                      "application/json",
+                                      "application/xhtml+xml",
+                                      "application/rss+xml",
+                                      "application/atom+xml",
+                                      "app/vdn.ms-fontobject",
+                                      "image/svg+xml",
+                                      "application/x-font-ttf",
+                                      "font/opentype",
+))
+
+# Generic binary files are often already compressed (archives, images, etc.), so they are only
+# gzipped when --aggressive-compress is given.
+AGGRESSIVE_COMPRESSIBLE_FILE_TYPES = COMPRESSIBLE_FILE_TYPES | frozenset(("application/octet-stream",))
+
+# Files smaller than this are not worth gzipping; the gzip framing can make them larger.
+MIN_GZIP_SIZE = 1024
+
+
+# Cache of guessed MIME types, keyed by file extension (e.g. ".js", or ".tar.gz" for compressed files).
+# It is cleared once it holds MIME_TYPE_CACHE_SIZE entries, so unusual extensions can't grow it without bound.
+MIME_TYPE_CACHE_SIZE = 4096
+_mime_type_cache = {}
+
+
+def __guess_mime_type(path):
+    """
+    Guess the MIME type of `path` from its file extension, defaulting to application/octet-stream
+    """
+    root, extension = posixpath.splitext(path)
+    if extension.lower() in mimetypes.encodings_map:
+        # mimetypes looks through an encoding suffix such as .gz to the extension before it
+        extension = posixpath.splitext(root)[1] + extension
+
+    mime_type = _mime_type_cache.get(extension)
+    if mime_type is None:
+        mime_type = mimetypes.guess_type('x' + extension)[0] or 'application/octet-stream'
+        if len(_mime_type_cache) >= MIME_TYPE_CACHE_SIZE:
+            _mime_type_cache.clear()
+        _mime_type_cache[extension] = mime_type
+    return mime_type
+
+
+def __gzip_compress(data, compresslevel=6):
+    """
+    Gzip `data` in a single pass, without the overhead of a GzipFile and an intermediate buffer
+    """
+    # wbits=31 makes zlib write a gzip header and trailer around the deflate stream
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+class GzipStream(io.RawIOBase):
+    """
+    Readable stream that gzips `data` as it is read, so a large file can be uploaded while it is being compressed
     """
 
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, data, compresslevel=6):
+        super(GzipStream, self).__init__()
+        self._data = data
+        self._offset = 0
+        self._compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, 31)
+        self._pending = b''
+        self._pending_offset = 0
+        self.compressed_size = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        # Compress more input until there is output to hand back, or the stream is finished
+        while self._pending_offset == len(self._pending) and self._compressor is not None:
+            chunk = self._data[self._offset:self._offset + self.CHUNK_SIZE]
+            self._offset += len(chunk)
+            if chunk:
+                self._pending = self._compressor.compress(chunk)
+            else:
+                self._pending = self._compressor.flush()
+                self._compressor = None
+            self._pending_offset = 0
+
+        count = min(len(buf), len(self._pending) - self._pending_offset)
+        buf[:count] = self._pending[self._pending_offset:self._pending_offset + count]
+        self._pending_offset += count
+        self.compressed_size += count
+        return count
+
+
+def __deploy_asset_to_s3(data, path, size, s3, bucket_name, compress=True, gzip_level=6, aggressive_compress=False,
+                         existing_etags=None, bucket_missing=None):
+    """
+    Deploy a single asset file to an S3 bucket. If `existing_etags` is given, files whose content matches the
+    ETag already stored under the same key are skipped and None is returned. If the bucket turns out not to exist, `bucket_missing`
+    is set and no further uploads are attempted.
+    """
+    if bucket_missing is not None and bucket_missing.is_set():
+        return 0
+
     try:
+        mime_type = __guess_mime_type(path)
         kwargs = {
-            'ContentType': mimetypes.guess_type(path)[0] or 'application/octet-stream',
+            'ContentType': mime_type,
             'CacheControl': "public, max-age=31536000",
             'ContentLength': size,
             'StorageClass': 'STANDARD',
@@ -73,77 +194,226 @@ def __deploy_asset_to_s3(data, path, size, bucket_name, compress=True):
         }
 
         # gzip the file if appropriate
-        if kwargs['ContentType'] in COMPRESSIBLE_FILE_TYPES and compress:
-            new_buffer = io.BytesIO()
-            gz_fd = gzip.GzipFile(compresslevel=9, mode="wb", fileobj=new_buffer)
-            gz_fd.write(data)
-            gz_fd.close()
+        compressible_types = AGGRESSIVE_COMPRESSIBLE_FILE_TYPES if aggressive_compress else COMPRESSIBLE_FILE_TYPES
+        gzip_file = compress and size >= MIN_GZIP_SIZE and mime_type in compressible_types
 
+        if gzip_file and size >= MULTIPART_THRESHOLD:
+            # Compress large files as the transfer manager reads them, so the first parts are uploading while the
+            # rest of the file is still being compressed. The compressed length isn't known up front.
+            del kwargs['ContentLength']
             kwargs['ContentEncoding'] = 'gzip'
-            kwargs['ContentLength'] = new_buffer.tell()
-
-            new_buffer.seek(0)
-            data = new_buffer.read()
 
-        logging.debug("Uploading %s (%s bytes)" % (path, kwargs['ContentLength']))
-        s3.Object(bucket_name, path).put(Body=data, **kwargs)
+            logging.debug("Uploading %s (%s bytes before compression)" % (path, size))
+            stream = GzipStream(data, gzip_level)
+            s3.meta.client.upload_fileobj(Fileobj=io.BufferedReader(stream, MULTIPART_THRESHOLD), Bucket=bucket_name,
+                                          Key=path, ExtraArgs=kwargs, Config=TRANSFER_CONFIG)
+            kwargs['ContentLength'] = stream.compressed_size
+
+        else:
+            if gzip_file:
+                data = __gzip_compress(data, gzip_level)
+                kwargs['ContentEncoding'] = 'gzip'
+                kwargs['ContentLength'] = len(data)
+
+            logging.debug("Uploading %s (%s bytes)" % (path, kwargs['ContentLength']))
+            if kwargs['ContentLength'] >= MULTIPART_THRESHOLD:
+                # The transfer manager works out part sizes itself, so it does not accept ContentLength
+                extra_args = dict((k, v) for k, v in kwargs.items() if k != 'ContentLength')
+                s3.meta.client.upload_fileobj(Fileobj=io.BytesIO(data), Bucket=bucket_name, Key=path, ExtraArgs=extra_args,
+                                              Config=TRANSFER_CONFIG)
+            else:
+                # Hash the body while it is still hot in cache so boto3 does not need to rescan it
+                md5 = hashlib.md5(data)
+                if existing_etags is not None and existing_etags.get(path) == md5.hexdigest():
+                    logging.debug("Skipping unchanged %s" % path)
+                    return None
+
+                kwargs['ContentMD5'] = base64.b64encode(md5.digest()).decode('ascii')
+                s3.Object(bucket_name, path).put(Body=data, **kwargs)
+
+    except (ClientError, S3UploadFailedError) as e:
+        if __s3_error_code(e) == 'NoSuchBucket' and bucket_missing is not None:
+            bucket_missing.set()
+        else:
+            logging.error("Unable to upload %s: %s" % (path, e))
+        return 0
 
-    except Exception as e:
-        import traceback
-        print(traceback.format_exc(e), file=sys.stderr)
+    except Exception:
+        print(traceback.format_exc(), file=sys.stderr)
         return 0
 
     # Return number of bytes uploaded.
     return kwargs['ContentLength']
 
 
-def deploy_tarball_to_s3(tarball_obj, bucket_name, prefix='', region='us-west-2', concurrency=50, no_compress=False, strip_components=0):
+def __s3_error_code(error):
     """
-    Upload the contents of `tarball_obj`, a File-like object representing a valid .tar.gz file, to the S3 bucket `bucket_name`
+    Return the S3 error code of a ClientError, or of the ClientError behind an S3UploadFailedError
     """
-    # Connect to S3 and get a reference to the bucket name we will push files to
-    conn = boto3.client('s3', region)
-    if conn is None:
-        logging.error("Invalid AWS region %s" % region)
-        return
+    if isinstance(error, S3UploadFailedError):
+        error = getattr(error, '__cause__', None) or getattr(error, '__context__', None)
+    if isinstance(error, ClientError):
+        return error.response.get('Error', {}).get('Code')
+    return None
+
+
+def __use_rapidgzip(fileobj):
+    """
+    Return True if `fileobj` is a gzip file on disk large enough to be worth decompressing with rapidgzip
+    """
+    if rapidgzip is None:
+        return False
+    try:
+        if os.fstat(fileobj.fileno()).st_size < RAPIDGZIP_MIN_SIZE:
+            return False
+        position = fileobj.tell()
+        magic = fileobj.read(2)
+        fileobj.seek(position)
+    except (AttributeError, EnvironmentError, ValueError):
+        return False
+    return magic == b'\x1f\x8b'
+
+
+def __list_etags(s3, bucket_name, prefix):
+    """
+    Return a dict mapping each key under `prefix` in the S3 bucket `bucket_name` to its ETag
+    """
+    etags = {}
+    paginator = s3.meta.client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            etags[obj['Key']] = obj['ETag'].strip('"')
+    return etags
+
 
-    # Ensure bucket exists before continuing
-    from botocore.client import ClientError
+def __deploy_asset_to_s3_and_release(semaphore, *args):
+    """
+    Deploy a single asset file to an S3 bucket, then release the in-flight slot held in `semaphore`
+    """
     try:
-        s3.meta.client.head_bucket(Bucket=bucket_name)
-    except ClientError:
-        logging.error("S3 bucket %s does not exist in region %s" % (bucket_name, region))
-        return
+        return __deploy_asset_to_s3(*args)
+    finally:
+        semaphore.release()
+
+
+def deploy_tarball_to_s3(tarball_obj, bucket_name, prefix='', region='us-west-2', concurrency=50, no_compress=False, strip_components=0, gzip_level=6,
+                         aggressive_compress=False, skip_bucket_check=False, skip_unchanged=False):
+    """
+    Upload the contents of `tarball_obj`, a File-like object representing a valid .tar.gz file, to the S3 bucket `bucket_name`
+    """
+    # Connect to S3 once, with enough pooled HTTP connections for every concurrent upload to reuse one rather than
+    # opening a new connection per file. Each upload may be a multipart upload sending several parts at once.
+    config = Config(max_pool_connections=concurrency * MULTIPART_CONCURRENCY,
+                    retries={'max_attempts': 5, 'mode': 'adaptive'})
+    s3 = boto3.resource('s3', region_name=region, config=config)
+
+    # Ensure bucket exists before continuing, unless the caller would rather save the round trip
+    if not skip_bucket_check:
+        try:
+            s3.meta.client.head_bucket(Bucket=bucket_name)
+        except ClientError:
+            logging.error("S3 bucket %s does not exist in region %s" % (bucket_name, region))
+            return
+
+    # Fetch the ETags of files already in the bucket so unchanged files can be skipped.
+    # Only single-PUT uploads have an MD5 ETag, so larger files are always uploaded.
+    existing_etags = None
+    if skip_unchanged:
+        try:
+            existing_etags = __list_etags(s3, bucket_name, prefix)
+        except ClientError as e:
+            logging.error("Unable to list S3 bucket %s: %s" % (bucket_name, e))
+            return
+
+    # S3 keys always use '/' as the separator, whatever the local OS
+    key_prefix = prefix.rstrip('/') + '/' if prefix else ''
+
+    # Decompress large gzipped tarballs in parallel when rapidgzip is installed; tarfile then reads plain tar data
+    use_rapidgzip = __use_rapidgzip(tarball_obj)
 
     # Open the tarball
+    tar_fileobj = tarball_obj
     try:
-        with tarfile.open(name=None, mode="r:*", fileobj=tarball_obj) as tarball:
+        tar_mode = "r:*"
+        if use_rapidgzip:
+            tar_fileobj, tar_mode = rapidgzip.RapidgzipFile(tarball_obj, parallelization=0), "r:"
 
-            files_uploaded = 0
+        with tarfile.open(name=None, mode=tar_mode, fileobj=tar_fileobj) as tarball:
 
-            # Parallelize the uploads so they don't take ages
+            files_uploaded = 0
+            # Updated from the pool's result handler thread as uploads finish
+            results = {'skipped': 0}
+
+            def count_result(uploaded_bytes):
+                if uploaded_bytes is None:
+                    results['skipped'] += 1
+
+            # An uncompressed tarball on disk can be memory-mapped so file data is sliced straight out of the
+            # page cache instead of being read through tarfile's file wrapper.
+            tarball_map = None
+            if tarball.fileobj is tarball_obj:
+                try:
+                    tarball_map = mmap.mmap(tarball_obj.fileno(), 0, access=mmap.ACCESS_READ)
+                except (AttributeError, ValueError, EnvironmentError):
+                    pass
+
+            # If tarfile reads the file object directly (it isn't wrapping it in a decompressor), file data can be
+            # read from each member's offset without going through tarfile's file wrapper.
+            direct_reads = tarball.fileobj is tar_fileobj
+
+            # Parallelize the uploads so they don't take ages. Compression also happens in these worker threads;
+            # zlib (and zlib-ng) release the GIL while deflating, so threads compress on multiple cores without
+            # the cost of copying file bodies to worker processes.
             pool = ThreadPool(concurrency)
 
+            # Bound the number of file bodies held in memory to the number of concurrent uploads
+            in_flight = threading.BoundedSemaphore(concurrency)
+
+            # Set by the first upload that finds the bucket doesn't exist, so the rest of the tarball isn't read
+            bucket_missing = threading.Event()
+
             # Iterate over the tarball's contents.
             try:
                 for member in tarball:
 
+                    if bucket_missing.is_set():
+                        break
+
                     # Ignore directories, links, devices, fifos, etc.
                     if not member.isfile():
                         continue
 
                     # Mimic the behaviour of tar -x --strip-components=
-                    stripped_name = member.name.split('/')[strip_components:]
-                    if not bool(stripped_name):
-                        continue
+                    name = member.name
+                    if strip_components:
+                        parts = name.split('/', strip_components)
+                        if len(parts) <= strip_components:
+                            continue
+                        name = parts[strip_components]
+
+                    path = key_prefix + name
 
-                    path = os.path.join(prefix, '/'.join(stripped_name))
+                    # Wait for an upload slot before reading more file data into memory
+                    in_flight.acquire()
 
                     # Read file data from the tarball
-                    fd = tarball.extractfile(member)
+                    if tarball_map is not None and not member.issparse():
+                        data = tarball_map[member.offset_data:member.offset_data + member.size]
+                    elif direct_reads and not member.issparse():
+                        tarball.fileobj.seek(member.offset_data)
+                        data = tarball.fileobj.read(member.size)
+                    else:
+                        data = tarball.extractfile(member).read()
+
+                    # Reading past the end of a truncated tarball silently returns less data
+                    if len(data) != member.size:
+                        raise tarfile.ReadError("unexpected end of data")
 
                     # Send a job to the pool.
-                    pool.apply_async(__deploy_asset_to_s3, (fd.read(), path, member.size, bucket_name, not no_compress))
+                    pool.apply_async(__deploy_asset_to_s3_and_release,
+                                     (in_flight, data, path, member.size, s3, bucket_name, not no_compress, gzip_level,
+                                      aggressive_compress, existing_etags, bucket_missing),
+                                     callback=count_result)
 
                     files_uploaded += 1
 
@@ -158,12 +428,31 @@ def deploy_tarball_to_s3(tarball_obj, bucket_name, prefix='', region='us-west-2'
             finally:
                 pool.close()
                 pool.join()  # Wait for all transfers to finish
-                print("Uploaded %i files" % (files_uploaded))
+                if tarball_map is not None:
+                    tarball_map.close()
+                if bucket_missing.is_set():
+                    logging.error("S3 bucket %s does not exist in region %s" % (bucket_name, region))
+                elif skip_unchanged:
+                    print("Uploaded %i files, skipped %i unchanged files" % (files_uploaded - results['skipped'],
+                                                                           results['skipped']))
+                else:
+                    print("Uploaded %i files" % (files_uploaded))
 
     except tarfile.ReadError:
         print("Unable to read asset tarfile", file=sys.stderr)
         return
 
+    except RAPIDGZIP_ERRORS:
+        # rapidgzip reports corrupt gzip data with these; when it isn't decoding the tarball they are real errors
+        if not use_rapidgzip:
+            raise
+        print("Unable to read asset tarfile", file=sys.stderr)
+        return
+
+    finally:
+        if tar_fileobj is not tarball_obj:
+            tar_fileobj.close()
+
 
 def main():
     parser = argparse.ArgumentParser(description="Unpack a tarball from the local filesystem to an S3 bucket")
@@ -176,6 +465,14 @@ def main():
     parser.add_argument("--debug", action="store_true", help="show verbose debug output")
     parser.add_argument("--no-compress", action="store_true",
                         help="disable gzip compression of known file types")
+    parser.add_argument("--gzip-level", dest="gzip_level", type=int, default=6, choices=range(1, 10),
+                        metavar="{1-9}", help="gzip compression level for compressible files. Default=6")
+    parser.add_argument("--aggressive-compress", action="store_true",
+                        help="also gzip files with an unknown type (application/octet-stream)")
+    parser.add_argument("--skip-bucket-check", action="store_true",
+                        help="don't check that the bucket exists before uploading")
+    parser.add_argument("--skip-unchanged", action="store_true",
+                        help="don't upload files whose content matches the file already in the bucket")
     parser.add_argument("--strip-components", dest="strip_components", type=int, default=0,
                         help="Remove the specified number of leading path elements. Pathnames with fewer elements will be silently skipped. Default=0")
     parser.add_argument("filename", type=str, help="File to load")
@@ -187,8 +484,11 @@ def main():
     else:
         logging.basicConfig(level=logging.INFO)
 
-    with open(args.filename, "rb") as fd:
-        deploy_tarball_to_s3(fd, args.bucket, args.prefix, args.region, args.concurrency, args.no_compress, args.strip_components)
+    # Read the tarball in large blocks; the default buffer means a read syscall every 8KB
+    with open(args.filename, "rb", buffering=TARBALL_READ_BUFFER_SIZE) as fd:
+        deploy_tarball_to_s3(fd, args.bucket, args.prefix, args.region, args.concurrency, args.no_compress, args.strip_components,
+                             args.gzip_level, args.aggressive_compress,
+                             args.skip_bucket_check, args.skip_unchanged)
 
 
 if __name__ == "__main__":